@@ -4,11 +4,66 @@ import altair as alt
 from sklearn.linear_model import LinearRegression
 from datetime import datetime
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import sparse
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import sqlite3
 import seaborn as sns
-import io 
+import io
 import calendar
-
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Copy-on-Write: seleccionar columnas, assign, rename o drop sobre df comparten los datos en lugar de copiarlos
+# a la defensiva, y no hay SettingWithCopyWarning. Los filtros con máscara booleana (df[df["Año"] == ...])
+# sí crean una copia de las filas seleccionadas; CoW solo evita las copias adicionales sobre ese resultado
+pd.set_option("mode.copy_on_write", True)
+
+# Esquema declarativo del CSV: cada columna se convierte una sola vez al cargar el archivo
+#   texto    -> cadena sin espacios extremos, faltantes como ""
+#   etiqueta -> entero guardado como texto (se usa en selectores y títulos)
+#   entero   -> entero, faltantes o inválidos como 0
+#   numerico -> flotante, faltantes o inválidos como 0
+#   fecha    -> datetime, inválidos como NaT
+ESQUEMA_COLUMNAS = {
+    "Cliente": "texto",
+    "SKU": "texto",
+    "Producto": "texto",
+    "Año": "etiqueta",
+    "Mes": "entero",
+    "Cantidad": "numerico",
+    "Importe": "numerico",
+    "PrecioU": "numerico",
+    "Fecha": "fecha",
+}
+
+# Formatos de exportación disponibles: nombre -> (extensión, tipo MIME)
+FORMATOS_EXPORTACION = {
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow IPC": ("arrow", "application/vnd.apache.arrow.file"),
+    "CSV comprimido (.csv.gz)": ("csv.gz", "application/gzip"),
+}
+# Vistas de periodo para comparar años: todas terminan alineadas al último mes cargado
+VISTAS_PERIODO = ["Año completo", "Año a la fecha (YTD)", "Últimos 12 meses"]
+
+MESES_ESPANOL = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"
+]
+
+LIMITE_FILAS_EXCEL = 1_048_575  # Filas de datos que caben en una hoja de Excel (más el encabezado)
+FILAS_EXCEL_POR_DEFECTO = 50_000  # Por encima de este tamaño la descarga sugiere Parquet
+FILAS_DESCARGA_INMEDIATA = 5_000  # Tablas en Excel hasta este tamaño se descargan con un solo clic
+MAX_ARCHIVOS_EN_CACHE = 4  # Archivos distintos cuyos datos y resultados derivados se conservan en memoria
+MAX_ANOMALIAS_EN_CACHE = 2 * MAX_ARCHIVOS_EN_CACHE  # Combinaciones de archivo y meses de historia
+MAX_DESCARGAS_EN_CACHE = 16  # Archivos de descarga ya generados que se conservan en memoria
+TTL_CACHE = "1h"  # Tiempo máximo que un resultado en caché permanece en memoria
+COLUMNAS_INTERNAS = ["Periodo"]  # Columnas que agrega la carga para los cálculos; nunca se exportan
 
 
 # Función para cargar el nombre real del cliente desde secrets sin mostrar un error en pantalla
@@ -19,6 +74,410 @@ def get_cliente_name(identifier):
         # Registra un mensaje de error solo en los logs y retorna un valor por defecto
         return "Cliente desconocido"
 
+
+# Función para convertir una columna según su tipo en el esquema
+# Regresa la columna convertida, el número de valores faltantes y el número de valores rechazados
+def convertir_columna(columna, tipo):
+    faltantes = columna.isna()
+    if tipo == "texto":
+        return columna.astype(str).str.strip().where(~faltantes, ""), int(faltantes.sum()), 0
+
+    if tipo == "fecha":
+        convertida = pd.to_datetime(columna, errors="coerce")
+    else:
+        convertida = pd.to_numeric(columna, errors="coerce")
+    rechazados = int((convertida.isna() & ~faltantes).sum())
+
+    if tipo == "entero":
+        convertida = convertida.fillna(0).astype("int64")
+    elif tipo == "etiqueta":
+        convertida = convertida.fillna(0).astype("int64").astype(str)
+    elif tipo == "numerico":
+        convertida = convertida.fillna(0).astype("float64")
+    return convertida, int(faltantes.sum()), rechazados
+
+
+# Función para cargar y validar el CSV contra el esquema; se ejecuta una sola vez por archivo
+# La caché se indexa por clave_archivo (file_id del archivo subido): el contenido, con guion bajo,
+# no se lee ni se hashea en cada rerun
+# El DataFrame resultante se comparte entre reruns y debe tratarse como de solo lectura
+@st.cache_resource(show_spinner="Cargando archivo...", max_entries=MAX_ARCHIVOS_EN_CACHE, ttl=TTL_CACHE)
+def cargar_datos(clave_archivo, _archivo):
+    contenido = _archivo.getvalue()
+    tipos_texto = {col: str for col, tipo in ESQUEMA_COLUMNAS.items() if tipo == "texto"}
+    try:
+        # Intentar cargar datos con utf-8
+        df = pd.read_csv(io.BytesIO(contenido), encoding='utf-8', dtype=tipos_texto)
+    except UnicodeDecodeError:
+        # Si hay un error, intentar con otro encoding
+        df = pd.read_csv(io.BytesIO(contenido), encoding='latin1', dtype=tipos_texto)
+
+    for col, tipo in ESQUEMA_COLUMNAS.items():
+        if col not in df.columns:
+            logger.warning("Columna '%s' no encontrada en el archivo", col)
+            continue
+        df[col], faltantes, rechazados = convertir_columna(df[col], tipo)
+        if faltantes or rechazados:
+            logger.warning(
+                "Columna '%s' (%s): %d valores faltantes, %d valores rechazados",
+                col, tipo, faltantes, rechazados
+            )
+
+    # Generar el mapeo dinámicamente desde secrets
+    cliente_mapeo = {f'C{i+1}': get_cliente_name(f'C{i+1}') for i in range(11)}
+
+    # Convertir nombres de clientes en el DataFrame a formato estándar
+    df['Cliente'] = df['Cliente'].str.title()  # Normaliza mayúsculas
+    df['Cliente'] = df['Cliente'].map(cliente_mapeo).fillna(df['Cliente'])
+
+    # Normalización de SKUs
+    df['SKU'] = df['SKU'].str.upper()
+
+    # Llave entera de año-mes (año * 12 + mes - 1); -1 cuando el año o el mes no son válidos
+    # Es interna (ver COLUMNAS_INTERNAS): se quita de las descargas de filas
+    año = df["Año"].astype("int64")
+    periodo_valido = (año > 0) & df["Mes"].between(1, 12)
+    df["Periodo"] = (año * 12 + df["Mes"] - 1).where(periodo_valido, -1)
+    if not periodo_valido.all():
+        logger.warning("%d filas sin año-mes válido se excluyen de las vistas por periodo", int((~periodo_valido).sum()))
+
+    return df
+
+
+# Función para construir la rejilla mensual densa de Importe por entidad (Cliente, SKU, ...) y su suma acumulada
+# acumulado[:, k] es el Importe desde primer_periodo hasta el periodo primer_periodo + k - 1
+def rejilla_mensual(df, dimension, primer_periodo, n_periodos):
+    filas = df[(df["Periodo"] >= primer_periodo) & (df["Periodo"] < primer_periodo + n_periodos)]
+    idx, etiquetas = pd.factorize(filas[dimension], sort=True)
+    celdas = idx * n_periodos + (filas["Periodo"].to_numpy() - primer_periodo)
+    rejilla = np.bincount(
+        celdas, weights=filas["Importe"].to_numpy(), minlength=len(etiquetas) * n_periodos
+    ).reshape(len(etiquetas), n_periodos)
+
+    acumulado = np.zeros((len(etiquetas), n_periodos + 1))
+    np.cumsum(rejilla, axis=1, out=acumulado[:, 1:])
+    return np.asarray(etiquetas), acumulado
+
+
+# Función para construir el motor de periodos: una rejilla acumulada por dimensión sobre los mismos meses
+# primer_periodo y ultimo_periodo se pueden fijar para que un subconjunto use el mismo último mes que el archivo completo
+# Regresa None si ningún renglón tiene un Año y Mes válidos
+def motor_periodos(df, dimensiones, primer_periodo=None, ultimo_periodo=None):
+    if primer_periodo is None:
+        validos = df.loc[df["Periodo"] >= 0, "Periodo"]
+        if validos.empty:
+            return None
+        primer_periodo = int(validos.min()) // 12 * 12  # Enero del primer año
+        ultimo_periodo = int(validos.max())
+    n_periodos = ultimo_periodo - primer_periodo + 1
+
+    motor = {
+        "primer_periodo": primer_periodo,
+        "ultimo_periodo": ultimo_periodo,
+        "años": list(range(primer_periodo // 12, ultimo_periodo // 12 + 1)),
+    }
+    for dimension in dimensiones:
+        motor[dimension] = rejilla_mensual(df, dimension, primer_periodo, n_periodos)
+    return motor
+
+
+# Motor de periodos de Cliente y SKU para el archivo completo; se calcula una sola vez por archivo
+@st.cache_resource(show_spinner="Calculando periodos...", max_entries=MAX_ARCHIVOS_EN_CACHE, ttl=TTL_CACHE)
+def construir_motor_periodos(clave_archivo, _df):
+    return motor_periodos(_df, ["Cliente", "SKU"])
+
+
+# Función para calcular la ventana de meses [inicio, fin] de cada año según la vista de periodo
+#   Año completo         -> enero a diciembre
+#   Año a la fecha (YTD) -> enero al último mes cargado
+#   Últimos 12 meses     -> los 12 meses que terminan en el último mes cargado
+def ventanas_periodo(motor, vista):
+    años = np.array(motor["años"])
+    mes_final = motor["ultimo_periodo"] % 12
+
+    if vista == "Año completo":
+        inicio, fin = años * 12, años * 12 + 11
+    elif vista == "Año a la fecha (YTD)":
+        inicio, fin = años * 12, años * 12 + mes_final
+    elif vista == "Últimos 12 meses":
+        fin = años * 12 + mes_final
+        inicio = fin - 11
+    else:
+        raise ValueError(f"Vista de periodo desconocida: {vista}")
+    return años, inicio, fin
+
+
+# Función para listar los años cuya ventana empieza antes del primer mes cargado (sin historia completa)
+def años_incompletos(motor, vista):
+    años, inicio, fin = ventanas_periodo(motor, vista)
+    return [str(año) for año in años[inicio < motor["primer_periodo"]]]
+
+
+# Función para calcular el Importe de cada entidad y año según la vista de periodo
+# Regresa un DataFrame con una fila por entidad y una columna por año (etiqueta de texto, como la columna Año)
+# Los años cuya ventana empieza antes del primer mes cargado quedan en NaN en lugar de sumar una ventana parcial
+def totales_por_periodo(motor, dimension, vista):
+    etiquetas, acumulado = motor[dimension]
+    años, inicio, fin = ventanas_periodo(motor, vista)
+
+    # Diferencia de sumas acumuladas; el final se recorta al último mes cargado
+    n_periodos = acumulado.shape[1] - 1
+    desde = np.clip(inicio - motor["primer_periodo"], 0, n_periodos)
+    hasta = np.clip(fin - motor["primer_periodo"] + 1, 0, n_periodos)
+    totales = acumulado[:, hasta] - acumulado[:, desde]
+    totales[:, inicio < motor["primer_periodo"]] = np.nan
+    return pd.DataFrame(
+        totales,
+        index=pd.Index(etiquetas, name=dimension),
+        columns=[str(año) for año in años]
+    )
+
+
+# Función para calcular puntajes robustos de anomalía para todas las series de una rejilla a la vez
+# Cada mes se compara contra la mediana y la MAD de los `ventana` meses anteriores de la misma serie;
+# las series se procesan por bloques de filas para acotar la memoria de las ventanas deslizantes
+# Regresa dos matrices del tamaño de la rejilla: la mediana de referencia y el puntaje (NaN sin historia suficiente)
+def puntajes_anomalia(rejilla, ventana, bloque=5000):
+    n_series, n_periodos = rejilla.shape
+    mediana = np.full(rejilla.shape, np.nan)
+    puntaje = np.full(rejilla.shape, np.nan)
+    if n_periodos <= ventana:
+        return mediana, puntaje
+
+    for i in range(0, n_series, bloque):
+        # historia[:, k] son los meses k .. k + ventana - 1, que preceden al mes k + ventana
+        historia = sliding_window_view(rejilla[i:i + bloque, :-1], ventana, axis=1)
+        referencia = np.median(historia, axis=2)
+        mad = np.median(np.abs(historia - referencia[..., None]), axis=2)
+
+        # Escala robusta con pisos para que un mes normal no parezca anómalo:
+        #   desviación absoluta media      -> en series intermitentes la mediana y la MAD quedan en cero o casi cero
+        #   0.1 × |mediana|                -> series casi constantes
+        #   meses vacíos × compra típica   -> ventanas casi vacías; la compra típica es el Importe absoluto medio
+        #                                     de los meses con ventas anteriores al evaluado (sin meses futuros)
+        desviacion_media = np.mean(np.abs(historia - referencia[..., None]), axis=2)
+        meses_vacios = np.mean(historia == 0, axis=2)
+        previos = rejilla[i:i + bloque, :-1]
+        importe_previo = np.cumsum(np.abs(previos), axis=1)[:, ventana - 1:]
+        meses_con_ventas = np.cumsum(previos != 0, axis=1)[:, ventana - 1:]
+        compra_tipica = np.divide(
+            importe_previo, meses_con_ventas, out=np.zeros_like(importe_previo), where=meses_con_ventas > 0
+        )
+        escala = np.maximum.reduce([
+            1.4826 * mad, 1.2533 * desviacion_media, 0.1 * np.abs(referencia), meses_vacios * compra_tipica
+        ])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (rejilla[i:i + bloque, ventana:] - referencia) / escala
+        z[escala == 0] = np.nan  # Series sin ventas en todos los meses anteriores
+
+        mediana[i:i + bloque, ventana:] = referencia
+        puntaje[i:i + bloque, ventana:] = z
+    return mediana, puntaje
+
+
+# Puntajes de anomalía de todas las series mensuales de Cliente y SKU; se calcula una vez por archivo y ventana
+# _motor (sin hashear) es el motor de periodos del mismo archivo
+@st.cache_resource(show_spinner="Buscando anomalías...", max_entries=MAX_ANOMALIAS_EN_CACHE, ttl=TTL_CACHE)
+def construir_anomalias(clave_archivo, ventana, _motor):
+    anomalias = {"primer_periodo": _motor["primer_periodo"]}
+    for dimension in ["Cliente", "SKU"]:
+        etiquetas, acumulado = _motor[dimension]
+        rejilla = np.diff(acumulado, axis=1)  # Importe mensual a partir de la suma acumulada
+        mediana, puntaje = puntajes_anomalia(rejilla, ventana)
+        anomalias[dimension] = (etiquetas, rejilla, mediana, puntaje)
+    return anomalias
+
+
+# Función para listar las anomalías más grandes de todas las series, ordenadas por |puntaje|
+# Los meses sin historia (puntaje NaN) y los que coinciden con la mediana (puntaje 0) nunca son anomalías
+def ranking_anomalias(anomalias, cantidad, puntaje_minimo):
+    ranking = []
+    for dimension in ["Cliente", "SKU"]:
+        etiquetas, rejilla, mediana, puntaje = anomalias[dimension]
+        absoluto = np.where(np.isfinite(puntaje), np.abs(puntaje), 0.0).ravel()
+        k = min(cantidad, absoluto.size)
+        if k == 0:
+            continue
+
+        # argpartition evita ordenar todas las celdas; solo se ordenan las k mayores
+        mayores = np.argpartition(absoluto, -k)[-k:]
+        mayores = mayores[(absoluto[mayores] >= puntaje_minimo) & (absoluto[mayores] > 0)]
+        fila, columna = np.unravel_index(mayores, puntaje.shape)
+        periodo = columna + anomalias["primer_periodo"]
+
+        ranking.append(pd.DataFrame({
+            "Tipo": dimension,
+            "Serie": etiquetas[fila],
+            "Mes": [f"{p % 12 + 1:02d}/{p // 12}" for p in periodo],
+            "Importe": rejilla[fila, columna].round(2),
+            "Mediana": mediana[fila, columna].round(2),
+            "Puntaje": puntaje[fila, columna].round(2),
+            "Dirección": np.where(puntaje[fila, columna] > 0, "Pico", "Caída"),
+            "fila": fila,
+            "columna": columna,
+        }))
+
+    if not ranking:
+        return pd.DataFrame(columns=["Tipo", "Serie", "Mes", "Importe", "Mediana", "Puntaje", "Dirección", "fila", "columna"])
+    ranking = pd.concat(ranking, ignore_index=True)
+    orden = ranking["Puntaje"].abs().sort_values(ascending=False).index
+    return ranking.loc[orden].head(cantidad).reset_index(drop=True)
+
+
+# Función para describir la vista de periodo en los títulos de las gráficas
+def descripcion_vista(motor, vista):
+    ultimo_año, ultimo_mes = divmod(motor["ultimo_periodo"], 12)
+    if vista == "Año a la fecha (YTD)":
+        return f"Enero a {MESES_ESPANOL[ultimo_mes]} de cada año"
+    if vista == "Últimos 12 meses":
+        return f"12 meses terminando en {MESES_ESPANOL[ultimo_mes]} de cada año"
+    return f"(Hasta {ultimo_mes + 1}/{ultimo_año})"
+
+
+# Función para serializar un DataFrame en el formato de exportación elegido
+# Los formatos columnares se escriben con pyarrow directamente desde las columnas en memoria
+def exportar_tabla(df, formato, hoja):
+    if formato == "Excel (.xlsx)":
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name=hoja)
+        return buffer.getvalue()
+
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    if formato == "Parquet":
+        pq.write_table(tabla, sink, compression="zstd")
+    elif formato == "Arrow IPC":
+        with pa.ipc.new_file(sink, tabla.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+            writer.write_table(tabla)
+    elif formato == "CSV comprimido (.csv.gz)":
+        with pa.CompressedOutputStream(sink, "gzip") as comprimido:
+            pa_csv.write_csv(tabla, comprimido)
+    else:
+        raise ValueError(f"Formato de exportación desconocido: {formato}")
+    return sink.getvalue().to_pybytes()
+
+
+# Función para generar el archivo de descarga una sola vez por selección y formato
+# clave_descarga identifica los datos (archivo y filtros aplicados); el guion bajo evita hashear el DataFrame
+# Las columnas internas de la carga (COLUMNAS_INTERNAS) se quitan antes de exportar
+@st.cache_data(show_spinner="Preparando descarga...", max_entries=MAX_DESCARGAS_EN_CACHE, ttl=TTL_CACHE)
+def exportar_tabla_en_cache(clave_descarga, formato, hoja, _df):
+    return exportar_tabla(_df.drop(columns=COLUMNAS_INTERNAS, errors="ignore"), formato, hoja)
+
+
+# Función para mostrar el selector de formato y el botón de descarga de una tabla
+# Excel es el formato por defecto para tablas pequeñas; las grandes y las descargas de filas usan Parquet
+# Excel se omite cuando la tabla no cabe en una hoja
+# Las tablas pequeñas en Excel se generan de inmediato (un solo clic); las grandes, los otros formatos y las
+# descargas de filas (bajo_demanda=True) solo se generan al pulsar "Preparar descarga", y siguen disponibles
+# mientras no cambien el formato ni los filtros, que deben identificar por completo los datos de df
+def boton_descarga(df, nombre_archivo, hoja, key, filtros, etiqueta="Descargar", por_defecto=None, bajo_demanda=False):
+    formatos = list(FORMATOS_EXPORTACION)
+    if len(df) > LIMITE_FILAS_EXCEL:
+        formatos.remove("Excel (.xlsx)")
+    if por_defecto not in formatos:
+        por_defecto = "Excel (.xlsx)" if len(df) <= FILAS_EXCEL_POR_DEFECTO else "Parquet"
+
+    formato = st.selectbox(
+        f"Formato ({etiqueta.lower()})", formatos, index=formatos.index(por_defecto), key=f"formato_{key}"
+    )
+    extension, mime = FORMATOS_EXPORTACION[formato]
+
+    clave_descarga = (key, filtros)
+    inmediata = not bajo_demanda and formato == "Excel (.xlsx)" and len(df) <= FILAS_DESCARGA_INMEDIATA
+    if not inmediata and st.session_state.get(f"preparada_{key}") != (clave_descarga, formato):
+        if not st.button(f"Preparar descarga ({len(df):,} filas)", key=f"preparar_{key}"):
+            return
+        st.session_state[f"preparada_{key}"] = (clave_descarga, formato)
+
+    st.download_button(
+        label=f"{etiqueta} ({len(df):,} filas)",
+        data=exportar_tabla_en_cache(clave_descarga, formato, hoja, df),
+        file_name=f"{nombre_archivo}.{extension}",
+        mime=mime,
+        key=f"descarga_{key}"
+    )
+
+
+# Función para construir las matrices dispersas cliente × SKU por año; se calcula una sola vez por archivo
+# Regresa un diccionario con:
+#   clientes, skus, periodos -> etiquetas de filas, columnas y años
+#   por_periodo              -> {año: matriz CSR cliente × SKU con el Importe neto comprado}
+#   coocurrencia             -> matriz CSR SKU × SKU con el número de clientes que compran ambos
+# Un cliente "compra" un SKU en un año cuando su Importe neto de ese año es positivo; las filas
+# en cero y las devoluciones que dejan el neto en cero o negativo no cuentan como compra
+#   similitud                -> coocurrencia normalizada (similitud coseno entre SKUs)
+@st.cache_resource(show_spinner="Calculando compras cruzadas...", max_entries=MAX_ARCHIVOS_EN_CACHE, ttl=TTL_CACHE)
+def construir_matrices_compra(clave_archivo, _df):
+    df = _df  # Ya en caché por clave_archivo; el guion bajo evita hashear el DataFrame
+
+    cliente_idx, clientes = pd.factorize(df["Cliente"])
+    sku_idx, skus = pd.factorize(df["SKU"])
+    periodos = sorted(df["Año"].unique(), key=int)
+    forma = (len(clientes), len(skus))
+
+    # Una matriz cliente × SKU por año; coo_matrix suma los renglones duplicados
+    por_periodo = {}
+    for periodo in periodos:
+        filas = (df["Año"] == periodo).to_numpy()
+        por_periodo[periodo] = sparse.coo_matrix(
+            (df["Importe"].to_numpy()[filas], (cliente_idx[filas], sku_idx[filas])),
+            shape=forma
+        ).tocsr()
+
+    # Matriz binaria cliente × SKU: compró (neto positivo) en al menos un año
+    compras = sparse.csr_matrix(forma, dtype=np.int32)
+    for matriz in por_periodo.values():
+        compras = compras + (matriz > 0).astype(np.int32)
+    compras = (compras > 0).astype(np.int32)
+
+    # Coocurrencia SKU × SKU mediante producto disperso
+    coocurrencia = (compras.T @ compras).tocsr()
+
+    # Similitud coseno: D^-1/2 · C · D^-1/2, donde D es el número de clientes de cada SKU
+    # Los SKUs sin ninguna compra neta positiva tienen D = 0 y quedan con similitud 0
+    clientes_por_sku = coocurrencia.diagonal().astype(float)
+    with np.errstate(divide="ignore"):
+        escala = sparse.diags(np.where(clientes_por_sku > 0, 1 / np.sqrt(clientes_por_sku), 0))
+    similitud = (escala @ coocurrencia @ escala).tocsr()
+
+    return {
+        "clientes": np.asarray(clientes),
+        "skus": np.asarray(skus),
+        "periodos": periodos,
+        "por_periodo": por_periodo,
+        "coocurrencia": coocurrencia,
+        "similitud": similitud,
+    }
+
+
+# Función para listar los SKUs que cada cliente dejó de comprar o empezó a comprar entre dos años
+# Se calcula para todos los clientes a la vez con operaciones sobre las matrices dispersas
+def cambios_sku_por_cliente(matrices, periodo_anterior, periodo_actual):
+    anterior = matrices["por_periodo"][periodo_anterior]
+    actual = matrices["por_periodo"][periodo_actual]
+    compro_anterior = (anterior > 0).astype(np.int8)
+    compro_actual = (actual > 0).astype(np.int8)
+    ambos = compro_anterior.multiply(compro_actual)
+
+    cambios = []
+    for etiqueta, mascara, importes in [
+        ("Dejó de comprar", compro_anterior - ambos, anterior),
+        ("Nuevo", compro_actual - ambos, actual),
+    ]:
+        # Conservar el Importe solo en las posiciones de la máscara
+        seleccion = sparse.coo_matrix(importes.multiply(mascara))
+        seleccion.eliminate_zeros()
+        cambios.append(pd.DataFrame({
+            "Cliente": matrices["clientes"][seleccion.row],
+            "SKU": matrices["skus"][seleccion.col],
+            "Cambio": etiqueta,
+            "Importe": seleccion.data,
+        }))
+
+    return pd.concat(cambios, ignore_index=True).sort_values(["Cliente", "Cambio", "Importe"], ascending=[True, True, False])
+
 # Título de la aplicación
 st.title("ANÁLISIS MK")
 
@@ -26,61 +485,38 @@ st.title("ANÁLISIS MK")
 st.sidebar.title("Navegación")
 opcion = st.sidebar.selectbox(
     "Selecciona una pestaña:",
-    ["Sales Analysis", "SKU's Analysis"]
+    ["Sales Analysis", "SKU's Analysis", "Anomaly Detection"]
 )
 
 # Mostrar la opción de subir archivo solo si se seleccionó una opción válida
-if opcion in ["Sales Analysis", "SKU's Analysis"]:
+if opcion in ["Sales Analysis", "SKU's Analysis", "Anomaly Detection"]:
     st.markdown(f"#### Subir archivo CSV para {opcion}")
     uploaded_file = st.file_uploader("Elige un archivo CSV", type="csv")
     
     # Procesar el archivo si se ha subido
     if uploaded_file is not None:
-        try:
-            # Intentar cargar datos con utf-8
-            df = pd.read_csv(uploaded_file, encoding='utf-8')
-        except UnicodeDecodeError:
-            # Si hay un error, intentar con otro encoding
-            df = pd.read_csv(uploaded_file, encoding='latin1')
-
-        # Manejo de datos faltantes
-        df.fillna(0, inplace=True)  # Rellena los valores nulos con 0
-
-        # Generar el mapeo dinámicamente desde secrets
-        cliente_mapeo = {f'C{i+1}': get_cliente_name(f'C{i+1}') for i in range(11)}
-
-        # Convertir nombres de clientes en el DataFrame a formato estándar
-        df['Cliente'] = df['Cliente'].str.strip().str.title()  # Normaliza espacios y mayúsculas
-        df['Cliente'] = df['Cliente'].map(cliente_mapeo).fillna(df['Cliente'])
-
-        # Asegurarse de que las columnas Año y Mes sean de tipo string
-        # Convertir la columna "Año" a numérico, ignorando errores y manejando valores nulos
-        df["Año"] = pd.to_numeric(df["Año"], errors='coerce').fillna(0).astype(int).astype(str)
-        df["Mes"] = df["Mes"].astype(str)
-
-        # Asegurarse de que la columna Importe sea numérica
-        df["Importe"] = pd.to_numeric(df["Importe"], errors='coerce').fillna(0)
-
-        # Formatear la columna Importe con comas como separadores de miles sin decimales
-        df["Importe_formateado"] = df["Importe"].apply(lambda x: "{:,.0f}".format(x))
-
-        # Normalización de SKUs
-        def normalizar_sku(sku):
-            if isinstance(sku, str):  # Asegurarse de que el SKU sea una cadena
-                return sku.strip().upper()
-            return sku
-
-        df['SKU'] = df['SKU'].apply(normalizar_sku)
-
-        # Encontrar el último año y mes en el conjunto de datos
-        ultimo_año = df["Año"].max()
-        ultimo_mes = df[df["Año"] == ultimo_año]["Mes"].max()
+        # Cargar el archivo validado y tipado según ESQUEMA_COLUMNAS (en caché por file_id)
+        clave_archivo = uploaded_file.file_id
+        df = cargar_datos(clave_archivo, uploaded_file)
 
     st.write("---")
     if opcion == "Sales Analysis":
+        # Vista de periodo para las ventas por año y las comparativas (alineadas al último mes cargado)
+        motor = construir_motor_periodos(clave_archivo, df)
+        if motor is None:
+            st.warning("Ningún renglón del archivo tiene un Año y Mes válidos; no se pueden calcular las ventas por periodo.")
+            st.stop()
+        vista_periodo = st.radio("Periodo de comparación", VISTAS_PERIODO, horizontal=True, key="vista_periodo_ventas")
+        ventas_periodo = totales_por_periodo(motor, "Cliente", vista_periodo)
+
+        # Los años sin 12 meses de historia para la vista quedan fuera de las gráficas
+        años_sin_historia = años_incompletos(motor, vista_periodo)
+        if años_sin_historia:
+            st.caption(f"Sin historia completa para esta vista (no se muestran): {', '.join(años_sin_historia)}")
+
         # Gráfico de líneas de ventas totales por año
         st.subheader(f"VENTAS TOTALES POR AÑO:chart_with_upwards_trend:")
-        ventas_totales = df.groupby("Año", as_index=False)["Importe"].sum()
+        ventas_totales = ventas_periodo.drop(columns=años_sin_historia).sum().rename_axis("Año").reset_index(name="Importe")
         ventas_totales["Importe_formateado"] = ventas_totales["Importe"].apply(lambda x: "{:,.0f}".format(x))
 
         line_chart = alt.Chart(ventas_totales).mark_line(color='green').encode(
@@ -88,7 +524,7 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             y=alt.Y('Importe:Q', title='Importe Total'),
             tooltip=['Año', 'Importe_formateado']
         ).properties(
-            title=(f"(Hasta {ultimo_mes}/{ultimo_año})")
+            title=descripcion_vista(motor, vista_periodo)
         )
 
         # Añadir puntos en la gráfica de líneas
@@ -111,11 +547,8 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
         st.subheader("FLUCTUACIONES DE VENTAS POR CLIENTE:bar_chart:")
         cliente_seleccionado = st.selectbox("Selecciona un cliente", df["Cliente"].unique())
 
-        # Filtrar datos por cliente seleccionado
-        df_cliente = df[df["Cliente"] == cliente_seleccionado]
-
-        # Agrupar las ventas por año utilizando la columna Importe
-        ventas_cliente = df_cliente.groupby("Año", as_index=False)["Importe"].sum()
+        # Ventas del cliente seleccionado por año según la vista de periodo
+        ventas_cliente = ventas_periodo.drop(columns=años_sin_historia).reindex([cliente_seleccionado], fill_value=0).iloc[0].rename_axis("Año").reset_index(name="Importe")
         ventas_cliente["Importe_formateado"] = ventas_cliente["Importe"].apply(lambda x: "{:,.0f}".format(x))
 
         # Crear gráfico de barras para mostrar la fluctuación anual de ventas
@@ -124,7 +557,7 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             y=alt.Y('Importe:Q', title='Importe Total'),
             color=alt.Color('Año:O', legend=None)
         ).properties(
-            title=f'Fluctuación de Ventas de {cliente_seleccionado} por Año'
+            title=f'Fluctuación de Ventas de {cliente_seleccionado} por Año - {descripcion_vista(motor, vista_periodo)}'
         )
 
         # Añadir etiquetas de texto en las barras
@@ -148,18 +581,15 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
         año_seleccionado_2 = st.selectbox("Selecciona el segundo año", años_disponibles)
 
         if año_seleccionado_1 and año_seleccionado_2:
-            # Filtrar datos por cliente seleccionado para comparación
-            df_comparativa_cliente = df[df["Cliente"] == cliente_comparativa]
-
-            # Filtrar datos por años seleccionados
-            df_año_1 = df_comparativa_cliente[df_comparativa_cliente["Año"] == año_seleccionado_1].groupby("Cliente")["Importe"].sum().reset_index()
-            df_año_2 = df_comparativa_cliente[df_comparativa_cliente["Año"] == año_seleccionado_2].groupby("Cliente")["Importe"].sum().reset_index()
+            # Importe del cliente en los años seleccionados según la vista de periodo
+            importes = ventas_periodo.reindex(index=[cliente_comparativa], columns=[año_seleccionado_1, año_seleccionado_2], fill_value=0).iloc[0]
+            importes = importes.drop(labels=años_sin_historia, errors="ignore")
 
             # Crear un DataFrame para la comparación
             df_comparativa = pd.DataFrame({
-                'Cliente': [cliente_comparativa] * 2,
-                'Año': [año_seleccionado_1, año_seleccionado_2],
-                'Importe': [df_año_1['Importe'].sum(), df_año_2['Importe'].sum()]
+                'Cliente': [cliente_comparativa] * len(importes),
+                'Año': importes.index,
+                'Importe': importes.to_numpy()
             })
 
             # Formatear la columna Importe
@@ -172,7 +602,7 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                 color=alt.Color('Año:O', legend=None),
                 text='Importe_formateado:N'
             ).properties(
-                title=f'Comparativa de Ventas entre {año_seleccionado_1} y {año_seleccionado_2}'
+                title=f'Comparativa de Ventas entre {año_seleccionado_1} y {año_seleccionado_2} - {descripcion_vista(motor, vista_periodo)}'
             )
 
             # Añadir etiquetas de texto en las barras
@@ -195,35 +625,24 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
         año_seleccionado_2 = st.selectbox("Selecciona el segundo año", años_disponibles, key="año_2")
 
         if año_seleccionado_1 and año_seleccionado_2:
-            # Filtrar datos por cliente seleccionado para comparación
-            df_comparativa_cliente = df[df["Cliente"] == cliente_comparativa]
-
-            # Filtrar datos por años seleccionados
-            df_año_1 = df_comparativa_cliente[df_comparativa_cliente["Año"] == año_seleccionado_1].groupby("Cliente")["Importe"].sum().reset_index()
-            df_año_2 = df_comparativa_cliente[df_comparativa_cliente["Año"] == año_seleccionado_2].groupby("Cliente")["Importe"].sum().reset_index()
+            # Importe del cliente en los años seleccionados según la vista de periodo
+            importes = ventas_periodo.reindex(index=[cliente_comparativa], columns=[año_seleccionado_1, año_seleccionado_2], fill_value=0).iloc[0]
+            importes = importes.mask(importes.index.isin(años_sin_historia))  # Sin historia completa: vacío, no cero
 
             # Crear un DataFrame para la comparación con columnas Año1 y Año2
             df_comparativa = pd.DataFrame({
                 'Cliente': [cliente_comparativa],
-                f'Año1 ({año_seleccionado_1})': [df_año_1['Importe'].sum()],
-                f'Año2 ({año_seleccionado_2})': [df_año_2['Importe'].sum()]
+                f'Año1 ({año_seleccionado_1})': [importes.iloc[0]],
+                f'Año2 ({año_seleccionado_2})': [importes.iloc[1]]
             })
 
             # Mostrar DataFrame comparativo
             st.dataframe(df_comparativa)
 
-            # Botón para descargar el DataFrame en Excel
-            import io  # Importamos io para trabajar con el buffer
-            buffer = io.BytesIO()  # Creamos un buffer en memoria
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:  # Usamos ExcelWriter explícitamente
-                df_comparativa.to_excel(writer, index=False, sheet_name='Comparativa Ventas')  # Escribimos en el buffer
-            buffer.seek(0)  # Movemos el puntero al inicio del buffer
-
-            st.download_button(
-                label="Descargar en Excel",
-                data=buffer,  # Pasamos el buffer como archivo
-                file_name="comparativa_ventas.xlsx",  # Nombre del archivo de descarga
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Botón para descargar el DataFrame
+            boton_descarga(
+                df_comparativa, "comparativa_ventas", "Comparativa Ventas", key="comparativa_ventas",
+                filtros=(clave_archivo, vista_periodo, cliente_comparativa, año_seleccionado_1, año_seleccionado_2)
             )
 
         st.write("---")
@@ -262,17 +681,12 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             # Mostrar DataFrame filtrado
             st.dataframe(df_resumen)
 
-            # Botón para descargar el DataFrame filtrado en Excel
-            buffer = io.BytesIO()  # Creamos un buffer en memoria
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:  # Usamos ExcelWriter explícitamente
-                df_resumen.to_excel(writer, index=False, sheet_name='Ventas Filtradas')  # Escribimos en el buffer
-            buffer.seek(0)  # Movemos el puntero al inicio del buffer
-
-            st.download_button(
-                label="Descargar en Excel",
-                data=buffer,  # Pasamos el buffer como archivo
-                file_name="ventas_filtradas.xlsx",  # Nombre del archivo de descarga
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Botones para descargar el resumen y las filas filtradas completas
+            filtros_ventas = (clave_archivo, tuple(clientes_seleccionados), tuple(años_seleccionados))
+            boton_descarga(df_resumen, "ventas_filtradas", "Ventas Filtradas", key="ventas_filtradas", filtros=filtros_ventas)
+            boton_descarga(
+                df_filtrado, "ventas_filtradas_detalle", "Detalle", key="ventas_filtradas_detalle",
+                filtros=filtros_ventas, etiqueta="Descargar filas", por_defecto="Parquet", bajo_demanda=True
             )
 
 
@@ -295,9 +709,6 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                 # Filtrar datos por el año seleccionado
                 df_mes = df[df["Año"] == año_seleccionado]
 
-            # Asegurarse de que la columna Mes esté en formato numérico
-            df_mes["Mes"] = pd.to_numeric(df_mes["Mes"], errors='coerce')
-
             # Agrupar ventas por mes y año
             ventas_mes = df_mes.groupby(["Año", "Mes"], as_index=False)["Importe"].sum()
 
@@ -403,16 +814,10 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                 st.metric(label="Promedio total de los años seleccionados", value=promedio_total_formateado)
             
             # Botón para descargar los datos
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                promedio_mensual[["Cliente", "Año", "Importe_formateado"]].to_excel(writer, index=False, sheet_name='Promedio Mensual Ventas')
-            buffer.seek(0)
-
-            st.download_button(
-                label="Descargar en Excel",
-                data=buffer,
-                file_name="promedio_mensual_ventas.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            boton_descarga(
+                promedio_mensual[["Cliente", "Año", "Importe_formateado"]],
+                "promedio_mensual_ventas", "Promedio Mensual Ventas", key="promedio_mensual",
+                filtros=(clave_archivo, tuple(clientes_promedio), tuple(años_promedio))
             )
 
 
@@ -501,9 +906,6 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                 # Filtrar datos por cliente y año seleccionados
                 df_producto = df[(df["Cliente"] == cliente_seleccionado_producto) & (df["Año"] == año_seleccionado_producto)]
 
-            # Asegurarse de que la columna "Cantidad" sea numérica
-            df_producto["Cantidad"] = pd.to_numeric(df_producto["Cantidad"], errors='coerce')
-
             # Calcular el total de ventas del año seleccionado
             total_ventas = df_producto["Importe"].sum()
             total_ventas_formateado = "{:,.0f}".format(total_ventas)
@@ -556,10 +958,10 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
 
             # Determinar el nombre del archivo según el cliente seleccionado
             if cliente_seleccionado_producto == "Todos los clientes":
-                nombre_archivo = "detalle_productos_vendidos_todos_los_clientes.xlsx"
+                nombre_archivo = "detalle_productos_vendidos_todos_los_clientes"
             else:
                 # Reemplazar espacios por guiones bajos y convertir a minúsculas para el nombre del archivo
-                nombre_archivo = f"detalle_productos_vendidos_{cliente_seleccionado_producto.replace(' ', '_').lower()}.xlsx"
+                nombre_archivo = f"detalle_productos_vendidos_{cliente_seleccionado_producto.replace(' ', '_').lower()}"
 
             # Mostrar gráfico
             st.altair_chart(bars_producto + text_producto, use_container_width=True)
@@ -568,18 +970,15 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             st.write(f"### Ventas: {suma_ventas_top_formateado} - {cliente_seleccionado_producto}   ({porcentaje_ventas_top_formateado})")
             st.dataframe(ventas_producto[['SKU', 'Producto', 'Cantidad', 'Importe_formateado', 'Porcentaje_formateado', 'Precio Promedio']])
 
-            # Botón para descargar el DataFrame en Excel
-            import io  # Importamos io para trabajar con el buffer
-            buffer = io.BytesIO()  # Creamos un buffer en memoria
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:  # Usamos ExcelWriter explícitamente
-                ventas_producto.to_excel(writer, index=False, sheet_name='Productos Vendidos')  # Escribimos en el buffer
-            buffer.seek(0)  # Movemos el puntero al inicio del buffer
-
-            st.download_button(
-                label="Descargar en Excel",
-                data=buffer,  # Pasamos el buffer como archivo
-                file_name=nombre_archivo,  # Nombre del archivo de descarga
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Botones para descargar la tabla y las filas filtradas completas
+            filtros_producto = (clave_archivo, cliente_seleccionado_producto, año_seleccionado_producto)
+            boton_descarga(
+                ventas_producto, nombre_archivo, "Productos Vendidos", key="productos_vendidos",
+                filtros=filtros_producto + (cantidad_productos,)
+            )
+            boton_descarga(
+                df_producto, f"{nombre_archivo}_filas", "Detalle", key="productos_vendidos_filas",
+                filtros=filtros_producto, etiqueta="Descargar filas", por_defecto="Parquet", bajo_demanda=True
             )
 
             # NUEVA SECCIÓN
@@ -602,10 +1001,6 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             else:
                 df_producto = df[(df["Cliente"] == cliente_seleccionado) & (df["Año"] == año_seleccionado)]
 
-            # Asegurarse de que la columna "Cantidad" y "Importe" sean numéricas
-            df_producto["Cantidad"] = pd.to_numeric(df_producto["Cantidad"], errors="coerce").fillna(0)
-            df_producto["Importe"] = pd.to_numeric(df_producto["Importe"], errors="coerce").fillna(0)
-
             # Calcular el precio promedio por SKU/Producto
             ventas_producto = df_producto.groupby(["SKU", "Producto"], as_index=False).agg(
                 {"Cantidad": "sum", "Importe": "sum"}
@@ -613,10 +1008,9 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             ventas_producto["Precio Promedio"] = ventas_producto["Importe"] / ventas_producto["Cantidad"]
             ventas_producto["Precio Promedio"] = ventas_producto["Precio Promedio"].fillna(0).round(2)
 
-            # Calcular las ventas por mes
-            df_producto["Fecha"] = pd.to_datetime(df_producto["Fecha"], errors="coerce")
-            df_producto = df_producto.dropna(subset=["Fecha"])  # Eliminar filas con fechas inválidas
-            df_producto["Mes"] = df_producto["Fecha"].dt.month
+            # Calcular las ventas por mes a partir de la Fecha (ya convertida al cargar)
+            # Con Copy-on-Write, assign no copia las demás columnas
+            df_producto = df_producto[df_producto["Fecha"].notna()].assign(Mes=lambda d: d["Fecha"].dt.month)
 
             ventas_mensuales = df_producto.groupby(["SKU", "Producto", "Mes"], as_index=False).agg(
                 {"Cantidad": "sum", "Importe": "sum"}
@@ -632,20 +1026,15 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             )
 
             # Nombres de columnas en español y alternar orden
-            meses_espanol = [
-                "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
-                "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"
-            ]
-
             ventas_pivot.columns = [
-                f"Importe {meses_espanol[col[1]-1]}" if col[0] == "Importe" else f"Cantidad {meses_espanol[col[1]-1]}"
+                f"Importe {MESES_ESPANOL[col[1]-1]}" if col[0] == "Importe" else f"Cantidad {MESES_ESPANOL[col[1]-1]}"
                 for col in ventas_pivot.columns
             ]
             ventas_pivot = ventas_pivot.reset_index()
 
             # Asegurar que todas las columnas de meses están presentes en el orden correcto
             columnas_ordenadas = []
-            for mes in meses_espanol:
+            for mes in MESES_ESPANOL:
                 columnas_ordenadas.append(f"Importe {mes}")
                 columnas_ordenadas.append(f"Cantidad {mes}")
 
@@ -668,17 +1057,12 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             st.write(f"#### Detalle Mensual de Productos Vendidos para {cliente_seleccionado} en {año_seleccionado}")
             st.dataframe(resultado_final)
 
-            # Descargar el DataFrame en Excel
-            buffer_mensual = io.BytesIO()
-            with pd.ExcelWriter(buffer_mensual, engine="openpyxl") as writer:
-                resultado_final.to_excel(writer, index=False, sheet_name="Productos Mensuales")
-            buffer_mensual.seek(0)
-
-            st.download_button(
-                label="Descargar en Excel",
-                data=buffer_mensual,
-                file_name=f"detalle_mensual_productos_{cliente_seleccionado.replace(' ', '_').lower()}_{año_seleccionado}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Descargar el DataFrame
+            boton_descarga(
+                resultado_final,
+                f"detalle_mensual_productos_{cliente_seleccionado.replace(' ', '_').lower()}_{año_seleccionado}",
+                "Productos Mensuales", key="productos_mensuales",
+                filtros=(clave_archivo, cliente_seleccionado, año_seleccionado)
             )
 
 
@@ -696,31 +1080,34 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
             años_comparativa = st.multiselect("Selecciona los años para la comparativa", sorted(df["Año"].unique()), key="años_comparativa")
 
             # Selección de SKUs para comparativa
-            # Normalizar SKUs: convertir a mayúsculas y eliminar espacios en blanco
-            skus_comparativa = df["SKU"].astype(str).apply(normalizar_sku).unique()
-            skus_comparativa = sorted(set(skus_comparativa))  # Eliminar duplicados
+            # Los SKUs ya vienen normalizados desde la carga
+            skus_comparativa = sorted(df["SKU"].unique())
             skus_seleccionados = st.multiselect("Selecciona los SKUs para la comparativa", skus_comparativa, key="skus_comparativa")
 
-            if cliente_comparativa and años_comparativa and skus_seleccionados:
-                if cliente_comparativa == "Todos los clientes":
-                    # Filtrar datos solo por los años seleccionados y SKUs especificados
-                    df_comparativa = df[(df["Año"].isin(años_comparativa)) & (df["SKU"].isin(skus_seleccionados))]
-                else:
-                    # Filtrar datos por cliente, años seleccionados y SKUs especificados
-                    df_comparativa = df[(df["Cliente"] == cliente_comparativa) & (df["Año"].isin(años_comparativa)) & (df["SKU"].isin(skus_seleccionados))]
-
-                # Agrupar ventas por año y SKU, sumando importe correctamente
-                ventas_comparativa = df_comparativa.groupby(["Año", "SKU"], as_index=False).agg(
-                    {"Importe": "sum"}
-                )
-                ventas_comparativa["Importe_formateado"] = ventas_comparativa["Importe"].apply(lambda x: "{:,.0f}".format(x))
-
-                # Crear un DataFrame con todos los SKUs y años seleccionados para evitar valores faltantes
-                skus_años = pd.MultiIndex.from_product([skus_seleccionados, años_comparativa], names=["SKU", "Año"])
-                ventas_comparativa = ventas_comparativa.set_index(["SKU", "Año"]).reindex(skus_años, fill_value=0).reset_index()
+            # Vista de periodo para la comparativa (alineada al último mes cargado)
+            vista_periodo_sku = st.radio("Periodo de comparación", VISTAS_PERIODO, horizontal=True, key="vista_periodo_sku")
+
+            motor = construir_motor_periodos(clave_archivo, df)
+            if motor is None:
+                st.warning("Ningún renglón del archivo tiene un Año y Mes válidos; no se puede calcular la comparativa por periodo.")
+            elif cliente_comparativa and años_comparativa and skus_seleccionados:
+                # Los años sin 12 meses de historia para la vista no se comparan
+                incompletos = años_incompletos(motor, vista_periodo_sku)
+                años_sin_historia = [año for año in años_comparativa if año in incompletos]
+                if años_sin_historia:
+                    st.caption(f"Sin historia completa para esta vista (no se muestran): {', '.join(años_sin_historia)}")
+                    años_comparativa = [año for año in años_comparativa if año not in años_sin_historia]
+
+                if cliente_comparativa != "Todos los clientes":
+                    # Rejilla de SKUs solo para el cliente, con los mismos meses que el archivo completo
+                    motor = motor_periodos(
+                        df[df["Cliente"] == cliente_comparativa], ["SKU"], motor["primer_periodo"], motor["ultimo_periodo"]
+                    )
 
-                # Pivotar los datos para comparación
-                comparativa_pivot = ventas_comparativa.pivot(index="SKU", columns="Año", values="Importe").reset_index()
+                # Importe por SKU y año según la vista, con todos los SKUs y años seleccionados para evitar valores faltantes
+                comparativa_pivot = totales_por_periodo(motor, "SKU", vista_periodo_sku).reindex(
+                    index=skus_seleccionados, columns=años_comparativa, fill_value=0
+                ).reset_index()
 
                 # Calcular diferencia porcentual entre años seleccionados
                 if len(años_comparativa) > 1:
@@ -739,7 +1126,7 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                     comparativa_pivot = comparativa_pivot[['SKU'] + [f'Importe {año}' for año in años_seleccionados] + ['Diferencia %']]
 
                     # Mostrar tabla comparativa
-                    st.write("### Tabla Comparativa de Ventas por Año")
+                    st.write(f"### Tabla Comparativa de Ventas por Año - {descripcion_vista(motor, vista_periodo_sku)}")
                     st.dataframe(comparativa_pivot)
         st.write("---")
         st.markdown("## PRECIO UNITARIO POR CLIENTE	:heavy_dollar_sign:")
@@ -780,3 +1167,122 @@ if opcion in ["Sales Analysis", "SKU's Analysis"]:
                 st.write(f"### Precios de los SKU seleccionados para {cliente_precio_unitario}")
                 st.dataframe(precios_filtrados)
 
+        st.write("---")
+        st.markdown("## COMPRAS CRUZADAS POR CLIENTE :link:")
+
+        # Matrices dispersas cliente × SKU por año (en caché por archivo)
+        matrices = construir_matrices_compra(clave_archivo, df)
+
+        # SKUs que compran los mismos clientes
+        sku_base = st.selectbox("Selecciona un SKU para ver con qué otros SKUs se compra", matrices["skus"], key="sku_cruzado")
+        cantidad_cruzados = st.number_input(
+            "Cantidad de SKUs relacionados a mostrar", min_value=1, max_value=50, value=10, step=1, key="cantidad_cruzados"
+        )
+
+        if sku_base:
+            i = int(np.flatnonzero(matrices["skus"] == sku_base)[0])
+            fila_similitud = matrices["similitud"].getrow(i)
+            fila_coocurrencia = matrices["coocurrencia"].getrow(i)
+
+            sku_relacionados = pd.DataFrame({
+                "SKU": matrices["skus"][fila_similitud.indices],
+                "Clientes en común": fila_coocurrencia[0, fila_similitud.indices].toarray().ravel(),
+                "Similitud": fila_similitud.data.round(3),
+            })
+            sku_relacionados = sku_relacionados[sku_relacionados["SKU"] != sku_base]
+            sku_relacionados = sku_relacionados.sort_values(["Similitud", "Clientes en común"], ascending=False).head(cantidad_cruzados)
+
+            st.write(f"### SKUs comprados junto con {sku_base} ({int(fila_coocurrencia[0, i])} clientes lo compran)")
+            st.dataframe(sku_relacionados, hide_index=True)
+
+        # SKUs que cada cliente dejó de comprar o empezó a comprar entre dos años
+        periodos = matrices["periodos"]
+        if len(periodos) > 1:
+            col1, col2 = st.columns(2)
+            with col1:
+                periodo_anterior = st.selectbox("Año anterior", periodos, index=len(periodos) - 2, key="periodo_anterior_cruzado")
+            with col2:
+                periodo_actual = st.selectbox("Año actual", periodos, index=len(periodos) - 1, key="periodo_actual_cruzado")
+
+            cambios = cambios_sku_por_cliente(matrices, periodo_anterior, periodo_actual)
+
+            cliente_cambios = st.selectbox(
+                "Selecciona un cliente para ver sus cambios de SKU",
+                ["Todos los clientes"] + list(matrices["clientes"]),
+                key="cliente_cambios_sku"
+            )
+            if cliente_cambios != "Todos los clientes":
+                cambios = cambios[cambios["Cliente"] == cliente_cambios]
+
+            st.write(f"### SKUs dejados y nuevos entre {periodo_anterior} y {periodo_actual}")
+            st.dataframe(cambios, hide_index=True)
+
+    elif opcion == "Anomaly Detection":
+        st.markdown("## ANOMALÍAS EN VENTAS MENSUALES :rotating_light:")
+
+        # Parámetros del puntaje robusto (mediana/MAD de los meses anteriores)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            ventana_anomalias = st.number_input("Meses de historia", min_value=3, max_value=36, value=12, step=1, key="ventana_anomalias")
+        with col2:
+            puntaje_minimo = st.number_input("Puntaje mínimo (|z| robusto)", min_value=0.0, value=3.5, step=0.5, key="puntaje_minimo")
+        with col3:
+            cantidad_anomalias = st.number_input("Cantidad de anomalías a mostrar", min_value=1, max_value=500, value=50, step=10, key="cantidad_anomalias")
+
+        motor = construir_motor_periodos(clave_archivo, df)
+        if motor is None:
+            st.warning("Ningún renglón del archivo tiene un Año y Mes válidos; no se pueden buscar anomalías mensuales.")
+            st.stop()
+        anomalias = construir_anomalias(clave_archivo, int(ventana_anomalias), motor)
+        ranking = ranking_anomalias(anomalias, int(cantidad_anomalias), puntaje_minimo)
+
+        series_evaluadas = len(anomalias["Cliente"][0]) + len(anomalias["SKU"][0])
+        st.write(f"### {len(ranking)} anomalías más grandes entre {series_evaluadas:,} series de clientes y SKUs")
+
+        if ranking.empty:
+            st.info("No se encontraron anomalías con el puntaje mínimo seleccionado.")
+        else:
+            columnas_ranking = ["Tipo", "Serie", "Mes", "Importe", "Mediana", "Puntaje", "Dirección"]
+            st.dataframe(ranking[columnas_ranking])
+            boton_descarga(
+                ranking[columnas_ranking], "anomalias_ventas", "Anomalías", key="anomalias",
+                filtros=(clave_archivo, int(ventana_anomalias), puntaje_minimo, int(cantidad_anomalias))
+            )
+
+            # Gráfica de la serie correspondiente a la anomalía seleccionada
+            seleccion = st.selectbox(
+                "Selecciona una anomalía para ver su gráfica",
+                ranking.index,
+                format_func=lambda i: f"{i}. {ranking.at[i, 'Tipo']} {ranking.at[i, 'Serie']} - {ranking.at[i, 'Mes']} ({ranking.at[i, 'Puntaje']:+.1f})",
+                key="anomalia_seleccionada"
+            )
+            anomalia = ranking.loc[seleccion]
+            etiquetas, rejilla, mediana, puntaje = anomalias[anomalia["Tipo"]]
+
+            periodos = anomalias["primer_periodo"] + np.arange(rejilla.shape[1])
+            serie = pd.DataFrame({
+                "Fecha": pd.to_datetime({"year": periodos // 12, "month": periodos % 12 + 1, "day": 1}),
+                "Importe": rejilla[anomalia["fila"]],
+                "Mediana": mediana[anomalia["fila"]],
+            })
+
+            linea_importe = alt.Chart(serie).mark_line(point=True).encode(
+                x=alt.X("Fecha:T", title="Mes"),
+                y=alt.Y("Importe:Q", title="Importe Total"),
+                tooltip=[alt.Tooltip("Fecha:T", format="%m/%Y"), alt.Tooltip("Importe:Q", format="$,.2f")]
+            )
+            linea_mediana = alt.Chart(serie).mark_line(strokeDash=[4, 4], color="gray").encode(
+                x="Fecha:T",
+                y="Mediana:Q"
+            )
+            punto_anomalia = alt.Chart(serie.iloc[[anomalia["columna"]]]).mark_point(color="red", size=200, filled=True).encode(
+                x="Fecha:T",
+                y="Importe:Q"
+            )
+
+            st.altair_chart(
+                (linea_importe + linea_mediana + punto_anomalia).properties(
+                    title=f"Ventas por Mes de {anomalia['Tipo']} {anomalia['Serie']} - {anomalia['Dirección']} en {anomalia['Mes']}"
+                ),
+                use_container_width=True
+            )
@@ -0,0 +1,351 @@
+"""Prueba de carga de app.py con sesiones concurrentes simuladas.
+
+Cada sesión es un AppTest headless de Streamlit que recorre una secuencia de
+interacciones realista (subir archivo, cambiar de pestaña, cambiar cliente y
+año, preparar una descarga) sobre un CSV sintético. Todas las sesiones comparten
+el mismo proceso, igual que en el servidor real, por lo que comparten las
+cachés de st.cache_resource y compiten por el GIL. Las cachés se calientan con
+una sesión previa que no se mide, y cada rerun se valida: uno que falla o que
+no muestra los widgets esperados cuenta como error y no como latencia. Con
+--archivo-por-sesion cada sesión sube su propio archivo, de modo que la carga,
+las cachés por archivo y la memoria de los datos de cada usuario se miden con
+las sesiones concurrentes.
+
+Antes de medir se verifica el ranking de anomalías sobre series intermitentes
+(un pico debe aparecer y las compras normales no); si falla, termina con error.
+
+Uso:
+    python load_test.py --sesiones 1,2,4,8,16 --filas 50000
+    python load_test.py --sesiones 1,2,4,8 --archivo-por-sesion
+"""
+import argparse
+import contextlib
+import gc
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest, app_test
+
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+# Función para generar un CSV sintético con las columnas que espera app.py
+def generar_csv(ruta, filas, clientes=11, skus=500, años=(2021, 2022, 2023, 2024), semilla=0):
+    rng = np.random.default_rng(semilla)
+    año = rng.choice(años, filas)
+    mes = rng.integers(1, 13, filas)
+    cantidad = rng.integers(1, 50, filas)
+    precio = rng.gamma(2.0, 150.0, filas).round(2)
+    df = pd.DataFrame({
+        "Cliente": [f"C{i}" for i in rng.integers(1, clientes + 1, filas)],
+        "SKU": [f"sku-{i:05d}" for i in rng.integers(0, skus, filas)],
+        "Producto": "Producto",
+        "Año": año,
+        "Mes": mes,
+        "Fecha": pd.to_datetime(pd.DataFrame({"year": año, "month": mes, "day": 1})).dt.strftime("%Y-%m-%d"),
+        "Cantidad": cantidad,
+        "PrecioU": precio,
+        "Importe": (cantidad * precio).round(2),
+    })
+    df["Producto"] = "Producto " + df["SKU"]
+    df.to_csv(ruta, index=False)
+
+
+# Script que ejecuta AppTest: sube el CSV a la sesión la primera vez y corre app.py
+# El archivo vive en st.session_state, como los archivos subidos en el servidor real, y
+# st.file_uploader (sustituido una sola vez en preparar_runtime_compartido) lo lee de ahí
+def _app_con_archivo(ruta_app, ruta_csv, file_id):
+    import io
+    import runpy
+    import streamlit as st
+
+    if "archivo_subido" not in st.session_state:
+        # Imita a UploadedFile: un BytesIO con file_id, que app.py usa como llave de caché
+        archivo_subido = io.BytesIO()
+        archivo_subido.file_id = file_id
+        with open(ruta_csv, "rb") as archivo:
+            archivo_subido.write(archivo.read())
+        st.session_state["archivo_subido"] = archivo_subido
+    runpy.run_path(ruta_app, run_name="__main__")
+
+
+# Función para preparar un runtime compartido por todas las sesiones, como en un servidor real
+# AppTest instala y retira su propio Runtime y sus secrets en cada rerun, lo que rompe a las
+# demás sesiones que corren en paralelo; aquí se instalan una sola vez para todo el proceso
+def preparar_runtime_compartido():
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+
+    # AppTest asigna y limpia Runtime._instance sobre esta subclase sin tocar el runtime compartido
+    app_test.Runtime = type("RuntimePorSesion", (Runtime,), {})
+    app_test.patch_config_options = lambda opciones: contextlib.nullcontext()
+    st.config.set_option("global.appTest", True)
+
+    # st.session_state es propio de cada sesión, así que cada hilo recibe su propio archivo
+    st.file_uploader = lambda *args, **kwargs: st.session_state.get("archivo_subido")
+
+    # Nombres para los identificadores C1..C11 del CSV sintético
+    secrets = Secrets()
+    secrets._secrets = {"clientes": {f"C{i}": f"Cliente {i}" for i in range(1, 12)}}
+    st.secrets = secrets
+
+
+# Función para obtener el RSS actual del proceso en MB
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # Fuera de Linux solo está disponible el pico de memoria: en bytes en macOS, en KB en los demás
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / 2**20 if sys.platform == "darwin" else pico / 2**10
+
+
+# Hilo que muestrea el RSS mientras las sesiones están vivas y guarda el pico
+class MuestreadorRSS(threading.Thread):
+    def __init__(self, intervalo=0.05):
+        super().__init__(daemon=True)
+        self.intervalo = intervalo
+        self.pico = rss_mb()
+        self._detener = threading.Event()
+
+    def run(self):
+        while not self._detener.wait(self.intervalo):
+            self.pico = max(self.pico, rss_mb())
+
+    def detener(self):
+        self._detener.set()
+        self.join()
+        self.pico = max(self.pico, rss_mb())
+        return self.pico
+
+
+# Función para encontrar un widget por su etiqueta en la ejecución actual
+def _widget(at, tipo, etiqueta):
+    for widget in getattr(at, tipo):
+        if widget.label == etiqueta:
+            return widget
+    raise LookupError(f"No se encontró {tipo} con etiqueta '{etiqueta}'")
+
+
+# Función para elegir otra opción de un selectbox (rota entre las opciones disponibles)
+def _cambiar_opcion(at, etiqueta, paso):
+    selector = _widget(at, "selectbox", etiqueta)
+    selector.select(selector.options[paso % len(selector.options)])
+
+
+# Widget que debe existir después de cada rerun según la pestaña activa
+WIDGET_ESPERADO = {
+    "Sales Analysis": ("selectbox", "Selecciona un cliente"),
+    "SKU's Analysis": ("selectbox", "Selecciona un cliente para el análisis de productos"),
+    "Anomaly Detection": ("number_input", "Meses de historia"),
+}
+
+
+# Secuencia de interacciones de una sesión; cada elemento produce un rerun
+# Cada paso es (nombre, pestaña esperada después del rerun, interacción)
+# Las descargas solo se generan al pulsar "Preparar descarga"; se mide la de las filas de productos
+def interacciones(paso):
+    return [
+        ("subir archivo", "Sales Analysis", lambda at: None),
+        ("cliente ventas", "Sales Analysis", lambda at: _cambiar_opcion(at, "Selecciona un cliente", paso)),
+        ("año comparativa", "Sales Analysis", lambda at: _cambiar_opcion(at, "Selecciona el segundo año", paso)),
+        ("año porcentaje", "Sales Analysis", lambda at: _cambiar_opcion(at, "Selecciona el año para el análisis", paso)),
+        ("pestaña SKU", "SKU's Analysis", lambda at: at.sidebar.selectbox[0].select("SKU's Analysis")),
+        ("cliente productos", "SKU's Analysis", lambda at: _cambiar_opcion(at, "Selecciona un cliente para el análisis de productos", paso + 1)),
+        ("año productos", "SKU's Analysis", lambda at: _cambiar_opcion(at, "Selecciona el año para el análisis de productos", paso)),
+        ("preparar descarga", "SKU's Analysis", lambda at: at.button(key="preparar_productos_vendidos_filas").click()),
+        ("año mensual", "SKU's Analysis", lambda at: _cambiar_opcion(at, "Selecciona un año", paso)),
+        ("pestaña anomalías", "Anomaly Detection", lambda at: at.sidebar.selectbox[0].select("Anomaly Detection")),
+        ("pestaña ventas", "Sales Analysis", lambda at: at.sidebar.selectbox[0].select("Sales Analysis")),
+    ]
+
+
+# Función para validar que el rerun produjo la página esperada; lanza una excepción si no
+def verificar_rerun(at, pestaña):
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    if not at.sidebar.selectbox or at.sidebar.selectbox[0].value != pestaña:
+        raise LookupError(f"El rerun no mostró la pestaña '{pestaña}'")
+    _widget(at, *WIDGET_ESPERADO[pestaña])
+
+
+# Función para crear una sesión; file_id distinto por sesión hace que cada una suba y procese su propio archivo
+# AppTest.from_function escribe el script en un archivo temporal
+# cuyo nombre depende solo del código, por lo que todas las sesiones comparten el mismo archivo.
+# Crear sesiones en paralelo lo trunca mientras otra sesión lo lee (rerun vacío), así que se
+# crean todas antes de arrancar los hilos
+def crear_sesion(ruta_csv, timeout, file_id=None):
+    return AppTest.from_function(
+        _app_con_archivo,
+        kwargs={"ruta_app": RUTA_APP, "ruta_csv": ruta_csv, "file_id": file_id or ruta_csv},
+        default_timeout=timeout
+    )
+
+
+# Función que ejecuta una sesión completa y registra la latencia de cada rerun válido
+# Un rerun con excepción o sin los widgets esperados cuenta como error, no como latencia
+def correr_sesion(at, repeticiones, latencias, errores, paso):
+    for repeticion in range(repeticiones):
+        for nombre, pestaña, interaccion in interacciones(paso + repeticion):
+            try:
+                interaccion(at)
+                inicio = time.perf_counter()
+                at.run()
+                duracion = time.perf_counter() - inicio
+                verificar_rerun(at, pestaña)
+                latencias.append(duracion)
+            except Exception as error:
+                errores.append(f"{nombre}: {error!r}")
+
+
+# Función para calentar las cachés de st.cache_resource con una sesión completa antes de medir
+def calentar(ruta_csv, timeout):
+    errores = []
+    correr_sesion(crear_sesion(ruta_csv, timeout), 1, [], errores, 0)
+    return errores
+
+
+# Función para verificar que el ranking de anomalías detecta picos en series intermitentes sin marcar sus compras normales
+#   Cliente 1 -> compra 100 cada tres meses, con un pico de 100000 en 06/2023
+#   Cliente 2 -> compras irregulares cerca de cero y alrededor de 125 (mediana casi cero), sin picos
+#   Cliente 3 -> 1000 al mes estable
+# Regresa la lista de problemas encontrados (vacía si el ranking es el esperado)
+def verificar_anomalias_intermitentes(directorio, timeout):
+    irregular = [1, 120, 1, 0, 150, 1, 130, 0, 0, 140, 0, 110, 0, 125, 0, 135]
+    filas = []
+    for n, (año, mes) in enumerate((año, mes) for año in range(2021, 2025) for mes in range(1, 13)):
+        importes = {
+            "C1": 100000 if (año, mes) == (2023, 6) else (100 if n % 3 == 0 else 0),
+            "C2": irregular[n % len(irregular)],
+            "C3": 1000,
+        }
+        for cliente, importe in importes.items():
+            if importe:
+                filas.append({
+                    "Cliente": cliente, "SKU": f"sku-{cliente}", "Producto": f"Producto {cliente}", "Año": año, "Mes": mes,
+                    "Fecha": f"{año}-{mes:02d}-01", "Cantidad": 1, "PrecioU": importe, "Importe": importe,
+                })
+    ruta_csv = os.path.join(directorio, "anomalias_intermitentes.csv")
+    pd.DataFrame(filas).to_csv(ruta_csv, index=False)
+
+    at = crear_sesion(ruta_csv, timeout)
+    at.run()
+    at.sidebar.selectbox[0].select("Anomaly Detection")
+    at.run()
+    if at.exception:
+        return [at.exception[0].message]
+    ranking = next((tabla.value for tabla in at.dataframe if "Puntaje" in tabla.value.columns), None)
+    if ranking is None:
+        return ["No se mostró el ranking de anomalías"]
+
+    problemas = []
+    pico = ranking[(ranking["Serie"].isin(["Cliente 1", "SKU-C1"])) & (ranking["Mes"] == "06/2023")]
+    if len(pico) != 2:
+        problemas.append("El pico de 100000 en la serie intermitente no aparece en el ranking")
+    falsos = ranking.drop(pico.index)
+    if not falsos.empty:
+        problemas.append(f"Compras normales marcadas como anomalía: {falsos[['Serie', 'Mes', 'Puntaje']].to_dict('records')}")
+    return problemas
+
+
+# Función que corre N sesiones concurrentes y resume latencia, memoria y rendimiento
+# Con archivo_por_sesion cada sesión usa un file_id nuevo: la carga, los fallos de caché y los datos de
+# cada usuario entran en la medición; si no, todas comparten el archivo ya en caché del calentamiento
+def medir(ruta_csv, sesiones, repeticiones, timeout, archivo_por_sesion=False):
+    latencias, errores = [], []
+    gc.collect()
+    rss_base = rss_mb()
+
+    file_ids = [
+        f"{ruta_csv}#{sesiones}-{i}" if archivo_por_sesion else ruta_csv
+        for i in range(sesiones)
+    ]
+    sesiones_at = [crear_sesion(ruta_csv, timeout, file_id) for file_id in file_ids]
+    hilos = [
+        threading.Thread(target=correr_sesion, args=(at, repeticiones, latencias, errores, i))
+        for i, at in enumerate(sesiones_at)
+    ]
+    muestreador = MuestreadorRSS()
+    muestreador.start()
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+    rss_pico = muestreador.detener()
+
+    latencias = np.array(latencias) if latencias else np.array([np.nan])
+    return {
+        "Sesiones": sesiones,
+        "Reruns": int(np.isfinite(latencias).sum()),
+        "p50 (s)": round(float(np.nanpercentile(latencias, 50)), 3),
+        "p95 (s)": round(float(np.nanpercentile(latencias, 95)), 3),
+        "Reruns/s": round(float(np.isfinite(latencias).sum() / duracion), 2),
+        "RSS pico (MB)": round(rss_pico, 1),
+        "RSS/sesión (MB)": round((rss_pico - rss_base) / sesiones, 1),
+        "Errores": len(errores),
+    }, errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de app.py con sesiones concurrentes")
+    parser.add_argument("--sesiones", default="1,2,4,8", help="niveles de concurrencia separados por comas")
+    parser.add_argument("--filas", type=int, default=50000, help="filas del CSV sintético")
+    parser.add_argument("--repeticiones", type=int, default=1, help="veces que cada sesión repite la secuencia")
+    parser.add_argument("--timeout", type=float, default=120, help="segundos máximos por rerun")
+    parser.add_argument("--csv", help="usar un CSV existente en lugar del sintético")
+    parser.add_argument(
+        "--archivo-por-sesion", action="store_true",
+        help="cada sesión sube su propio archivo (file_id distinto) en lugar de compartir el ya cargado"
+    )
+    args = parser.parse_args()
+
+    preparar_runtime_compartido()
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_csv = args.csv
+        if ruta_csv is None:
+            ruta_csv = os.path.join(directorio, "ventas_sinteticas.csv")
+            generar_csv(ruta_csv, args.filas)
+
+        problemas = verificar_anomalias_intermitentes(directorio, args.timeout)
+        for problema in problemas:
+            print(f"    verificación de anomalías: {problema}", flush=True)
+        if problemas:
+            raise SystemExit(1)
+
+        # Las cachés por archivo se llenan una sola vez, como en un servidor ya en uso
+        for error in calentar(ruta_csv, args.timeout):
+            print(f"    calentamiento: {error}", flush=True)
+
+        resultados = []
+        for sesiones in [int(n) for n in args.sesiones.split(",")]:
+            resultado, errores = medir(ruta_csv, sesiones, args.repeticiones, args.timeout, args.archivo_por_sesion)
+            resultados.append(resultado)
+            print(resultado, flush=True)
+            for error in sorted(set(errores))[:5]:
+                print(f"    {error}", flush=True)
+
+    print()
+    print(pd.DataFrame(resultados).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()